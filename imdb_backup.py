@@ -1,26 +1,64 @@
 #!/usr/bin/env python3
+import contextlib
+import hashlib
 import json
 import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import zipfile
 from collections.abc import Generator, Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from pathlib import Path
+from typing import IO
 
+import lxml.html
 import requests
 import unidecode
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+IMDB_URL = 'https://www.imdb.com'
 REQUIRED_COOKIES = {'at-main', 'ubid-main', 'uu'}
 COOKIE_FNAME = 'imdb_cookie.json'
+USERID_CACHE_FNAME = 'userid_cache.json'
 ZIP_FNAME = 'imdb_exported_lists.zip'
+STORE_MAX_SIZE = 4096
+SPOOL_MAX_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+MAX_WORKERS = 8
+REQUEST_INTERVAL = 0.5
 README_REF = (
     'For more info check README.md.\n'
     '[https://github.com/monk-time/imdb-backup-lists/blob/master/README.md]'
 )
 
-MList = dict[str, str | bytes]
+# Lowercase ASCII alphanumerics, turn separators into hyphens, drop the rest
+SLUG_TABLE = {
+    ord(c): (
+        c.lower() if c.isalnum() else '-' if c in '-_' or c.isspace() else None
+    )
+    for c in map(chr, range(128))
+}
+RE_HYPHENS = re.compile(r'-{2,}')
+RE_LIST_ID = re.compile(r'..\d{6,}')
+XPATH_WATCHLIST_ID = 'string(//meta[@property="pageId"]/@content)'
+XPATH_LIST_LINKS = (
+    '//a[contains(concat(" ", normalize-space(@class), " "), " list-name ")]'
+)
+
+
+@dataclass(slots=True)
+class MList:
+    url: str
+    fname: str
+    title: str
+    index: int = 0  # position on the user's page, kept for lists.txt
+    content: IO[bytes] | None = None
 
 
 class LoginError(Exception):
@@ -31,15 +69,32 @@ class UrlParseError(Exception):
     pass
 
 
+class Throttle:
+    """Space out the starts of requests made from multiple threads."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        """Block until the next free slot; slots are handed out in order."""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
 def slugify(s: str) -> str:
     """Convert to lowercase ASCII with hyphens instead of underscores/spaces.
 
     Remove all non-alphanumeric characters and strip
-    leading and trailing whitespace.
+    leading and trailing whitespace and hyphens.
     """
-    s = unidecode.unidecode(s)
-    s = re.sub(r'[^\w\s-]', '', s).strip().lower()
-    return re.sub(r'[-_\s]+', '-', s)
+    s = unidecode.unidecode(s).translate(SLUG_TABLE).strip('-')
+    return RE_HYPHENS.sub('-', s)
 
 
 def load_imdb_cookies(cookie_path):
@@ -61,27 +116,83 @@ def load_imdb_cookies(cookie_path):
     raise FileNotFoundError(msg)
 
 
-def fetch_userid(cookies: dict) -> str:
+def create_session(cookies: dict) -> requests.Session:
+    """Create a session that keeps connections to IMDb alive.
+
+    The pool is large enough for all download threads to share it.
+    """
+    session = requests.Session()
+    session.cookies.update(cookies)
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    )
+    session.mount(IMDB_URL, adapter)
+    return session
+
+
+def cookie_fingerprint(cookies: dict) -> str:
+    """Get a short hash of cookies to use as a key in the user ID cache."""
+    data = json.dumps(cookies, sort_keys=True).encode()
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def load_userid_cache(cache_path: Path) -> dict[str, str]:
+    """Read the user ID cache; a missing or broken file counts as empty."""
+    try:
+        cache = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_userid(cache_path: Path, cookie_key: str, userid: str | None):
+    """Add user ID to the cache, or remove it from there if it's None."""
+    cache = load_userid_cache(cache_path)
+    if userid is None:
+        cache.pop(cookie_key, None)
+    else:
+        cache[cookie_key] = userid
+    # The cache is only an optimization, e.g. the folder may be read-only
+    with contextlib.suppress(OSError):
+        cache_path.write_text(json.dumps(cache, indent=2))
+
+
+def find_userid(url: str) -> str | None:
+    """Find the first 'ur' followed by digits in the URL."""
+    i = url.find('ur')
+    while i != -1:
+        j = i + 2
+        while j < len(url) and url[j].isdecimal():
+            j += 1
+        if j > i + 2:
+            return url[i:j]
+        i = url.find('ur', i + 1)
+    return None
+
+
+def fetch_userid(session: requests.Session) -> str:
     """Fetch user ID that is required for exporting any lists.
 
     Cookie validity will also be checked here.
     """
-    r = requests.head('https://www.imdb.com/profile', cookies=cookies)
+    r = session.head(f'{IMDB_URL}/profile')
     r.raise_for_status()
-    m = re.search(r'ur\d+', r.headers['Location'])
-    if not m:
+    userid = find_userid(r.headers['Location'])
+    if userid is None:
         msg = (
             "\n\nCan't log into IMDb.\n"
             f'Make sure that your IMDb cookie in {COOKIE_FNAME} is correct.\n'
             f'{README_REF}'
         )
         raise LoginError(msg)
-    return m.group()
+    return userid
 
 
 def get_fname(url: str, title: str) -> str:
     """Turn an IMDb list into {LIST_OR_USER_ID}_{TITLE_SLUG}.csv."""
-    match = re.search(r'..\d{6,}', url, re.MULTILINE)
+    match = RE_LIST_ID.search(url)
     if not match:
         msg = (
             f"\n\nCan't extract list/user ID from {url} "
@@ -92,82 +203,182 @@ def get_fname(url: str, title: str) -> str:
 
 
 def fetch_lists_info(
-    userid: str, cookies: dict
-) -> Generator[dict, None, None]:
-    r = requests.get(
-        f'https://www.imdb.com/user/{userid}/lists', cookies=cookies
-    )
+    userid: str, session: requests.Session
+) -> Generator[MList, None, None]:
+    # /lists doesn't have a link for watchlist that can be used for exporting,
+    # so its page is fetched as well; both requests are made in parallel
+    pages = [
+        f'{IMDB_URL}/user/{userid}/lists',
+        f'{IMDB_URL}/user/{userid}/watchlist',
+    ]
+    with ThreadPoolExecutor(max_workers=len(pages)) as pool:
+        r, r_wl = pool.map(session.get, pages)
     r.raise_for_status()
+    r_wl.raise_for_status()
 
     # Fetch two special lists: ratings and watchlist
     # /lists has an old link for ratings; easier to hardcode it
-    yield {
-        'url': f'/user/{userid}/ratings/',
-        'fname': get_fname(userid, 'ratings'),
-        'title': 'Ratings',
-    }
-    # /lists doesn't have a link for watchlist that can be used for exporting
-    r_wl = requests.get(
-        f'https://www.imdb.com/user/{userid}/watchlist', cookies=cookies
+    yield MList(
+        url=f'/user/{userid}/ratings/',
+        fname=get_fname(userid, 'ratings'),
+        title='Ratings',
     )
-    listid = (
-        BeautifulSoup(r_wl.text, 'html.parser')
-        .find('meta', property='pageId')
-        .get('content')
+    # Pass raw bytes to let lxml detect the encoding from the page itself
+    listid = lxml.html.fromstring(r_wl.content).xpath(XPATH_WATCHLIST_ID)
+    if not listid:
+        msg = (
+            "\n\nCan't find the watchlist ID (pageId) on "
+            f'{IMDB_URL}/user/{userid}/watchlist'
+        )
+        raise UrlParseError(msg)
+    yield MList(
+        url=f'/list/{listid}/',
+        fname=get_fname(userid, 'watchlist'),
+        title='Watchlist',
     )
-    yield {
-        'url': f'/list/{listid}/',
-        'fname': get_fname(userid, 'watchlist'),
-        'title': 'Watchlist',
-    }
 
     # Fetch the rest of user's lists
-    links = BeautifulSoup(r.text, 'html.parser').select('a.list-name')
+    links = lxml.html.fromstring(r.content).xpath(XPATH_LIST_LINKS)
     for link in links:
         url = link.get('href')
-        title = link.string
-        yield {'url': url, 'fname': get_fname(url, title), 'title': title}
+        title = link.text_content()
+        yield MList(url=url, fname=get_fname(url, title), title=title)
 
 
-def export(mlist: MList, cookies: dict) -> MList:
-    """All requests are throttled just in case."""
-    time.sleep(0.5)
-    print('Downloading:', mlist['title'].replace('\n', ' '))
-    r = requests.get(
-        f'https://www.imdb.com{mlist["url"]}export', cookies=cookies
+def log_in_and_fetch_lists_info(
+    session: requests.Session, cache_path: Path, cookie_key: str
+) -> tuple[str, list[MList]]:
+    """Check the cookies and collect info about all user's lists.
+
+    With a cached user ID the list pages don't have to wait for the login
+    check, so both are done in parallel.
+    """
+    userid = load_userid_cache(cache_path).get(cookie_key)
+    if userid is None:
+        userid = fetch_userid(session)
+        save_userid(cache_path, cookie_key, userid)
+        return userid, list(fetch_lists_info(userid, session))
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        login = pool.submit(fetch_userid, session)
+        info = pool.submit(lambda: list(fetch_lists_info(userid, session)))
+        try:
+            current_userid = login.result()
+        except (LoginError, requests.HTTPError):
+            save_userid(cache_path, cookie_key, None)
+            raise
+    if current_userid != userid:
+        # Shouldn't happen for the same cookies, but don't export wrong lists
+        save_userid(cache_path, cookie_key, current_userid)
+        return current_userid, list(fetch_lists_info(current_userid, session))
+    return userid, info.result()
+
+
+def export(
+    mlist: MList, session: requests.Session, throttle: Throttle
+) -> MList:
+    """All requests are throttled just in case.
+
+    The export is streamed into a temporary file that stays in memory
+    only while it's small.
+    """
+    throttle.wait()
+    print('Downloading:', mlist.title.replace('\n', ' '))
+    # Not a `with` block: the file is handed over to zip_all, which closes it
+    content = tempfile.SpooledTemporaryFile(  # noqa: SIM115
+        max_size=SPOOL_MAX_SIZE
     )
-    r.raise_for_status()
-    mlist['content'] = r.content
+    try:
+        with session.get(f'{IMDB_URL}{mlist.url}export', stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(CHUNK_SIZE):
+                content.write(chunk)
+    except BaseException:
+        # It may already be on disk, so don't wait for GC to clean it up
+        content.close()
+        raise
+    content.seek(0)
+    mlist.content = content
     return mlist
 
 
+def export_all(
+    mlists: Iterable[MList], session: requests.Session
+) -> Generator[MList, None, None]:
+    """Download lists in parallel, yielding each one as soon as it's ready.
+
+    A finished list is released as soon as it's consumed, so only lists
+    that are still in flight or waiting to be zipped are kept in memory.
+    Each list is numbered first, since they will arrive out of order.
+    """
+    throttle = Throttle(REQUEST_INTERVAL)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = set()
+        for index, ml in enumerate(mlists):
+            ml.index = index
+            futures.add(pool.submit(export, ml, session, throttle))
+        try:
+            for future in as_completed(futures):
+                futures.discard(future)
+                yield future.result()
+        finally:
+            # Don't keep downloading if zipping or one of the exports failed
+            pool.shutdown(cancel_futures=True)
+            # Exports that finished but weren't zipped may already be on disk
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    future.result().content.close()
+
+
 def zip_all(mlists: Iterable[MList], zip_fname=ZIP_FNAME):
     """Write all downloaded movielists into a zip archive.
 
-    A file with original list names (quoted if multi-line) is also added.
+    A file with original list names (quoted if multi-line) is also added,
+    listing them in their original order regardless of download order.
+    Small files are stored as is, the rest use the fastest compression level.
     """
     with zipfile.ZipFile(
-        zip_fname, mode='w', compression=zipfile.ZIP_DEFLATED
+        zip_fname, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=1
     ) as zf:
         titles = []
         for ml in mlists:
-            print('  ->', ml['fname'])
-            zf.writestr(ml['fname'], ml['content'])
+            print('  ->', ml.fname)
+            zinfo = zipfile.ZipInfo(ml.fname, time.localtime()[:6])
+            # A known size lets zipfile decide upfront if ZIP64 is needed
+            zinfo.file_size = ml.content.seek(0, os.SEEK_END)
+            ml.content.seek(0)
+            zinfo.compress_type = (
+                zipfile.ZIP_STORED
+                if zinfo.file_size <= STORE_MAX_SIZE
+                else zipfile.ZIP_DEFLATED
+            )
+            zinfo.compress_level = 1
+            with ml.content as src, zf.open(zinfo, mode='w') as dest:
+                shutil.copyfileobj(src, dest, CHUNK_SIZE)
+            # Don't hold the body until the next download replaces `ml`
+            ml.content = None
             # After the Dec'17 redesign IMDb lists can have multi-line titles
-            title = ml['title']
+            title = ml.title
             if '\n' in title:
                 # zipfile.writestr doesn't do automatic line ending conversion
                 title = f'"{title}"'.replace('\n', os.linesep)
-            titles.append(f'{ml["fname"]}: {title}')
-        zf.writestr('lists.txt', os.linesep.join(titles))
+            titles.append((ml.index, f'{ml.fname}: {title}'.encode()))
+        titles.sort()
+        zf.writestr(
+            'lists.txt', os.linesep.encode().join(t for _, t in titles)
+        )
 
 
 def backup(cookie_path):
     cookies = load_imdb_cookies(cookie_path)
-    userid = fetch_userid(cookies)
+    session = create_session(cookies)
+    cache_path = cookie_path.with_name(USERID_CACHE_FNAME)
+    cookie_key = cookie_fingerprint(cookies)
+    userid, mlists = log_in_and_fetch_lists_info(
+        session, cache_path, cookie_key
+    )
     print(f'Successfully logged in as user {userid}')
-    mlists = fetch_lists_info(userid, cookies)
-    zip_all(export(ml, cookies) for ml in mlists)
+    zip_all(export_all(mlists, session))
 
 
 def pause_before_exit_unless_run_with_flag():